@@ -0,0 +1,105 @@
+# _kernels.py
+# Purpose: Numba-compiled kernels for the innermost loops of ISC computation.
+# Numba is an optional dependency; when it can't be imported, NUMBA_AVAILABLE
+# is False and callers fall back to their NumPy implementations.
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    logger.debug("Numba not found; using NumPy implementations instead")
+    NUMBA_AVAILABLE = False
+
+# Voxels per block; each block's TR loop streams along contiguous rows
+_VOXEL_BLOCK = 1024
+
+
+if NUMBA_AVAILABLE:
+
+    @njit(parallel=True, error_model='numpy', cache=True)
+    def pearson_batched(X, Y):
+        """
+        Column-wise Pearson correlation between two C-contiguous
+        (n_TRs, n_voxels) arrays.
+
+        Data are read in a single pass: blocks of voxels are spread across
+        threads, and each block walks the TRs row by row while updating
+        running means and co-moments (Welford's algorithm) in float64. This
+        avoids the cancellation of the raw sum-of-squares formula on data with
+        large offsets (eg., raw BOLD intensities). Returns NaN for voxels
+        containing NaNs or with zero variance, matching array_correlation.
+        """
+        n, n_voxels = X.shape
+        mx = np.zeros(n_voxels)
+        my = np.zeros(n_voxels)
+        cxx = np.zeros(n_voxels)
+        cyy = np.zeros(n_voxels)
+        cxy = np.zeros(n_voxels)
+        r = np.empty(n_voxels, dtype=X.dtype)
+        for b in prange((n_voxels + _VOXEL_BLOCK - 1) // _VOXEL_BLOCK):
+            v0 = b * _VOXEL_BLOCK
+            v1 = min(n_voxels, v0 + _VOXEL_BLOCK)
+            for t in range(n):
+                w = 1.0 / (t + 1)
+                for v in range(v0, v1):
+                    x = np.float64(X[t, v])
+                    y = np.float64(Y[t, v])
+                    dx = x - mx[v]
+                    dy = y - my[v]
+                    mx[v] += dx * w
+                    my[v] += dy * w
+                    ey = y - my[v]
+                    cxy[v] += dx * ey
+                    cxx[v] += dx * (x - mx[v])
+                    cyy[v] += dy * ey
+            for v in range(v0, v1):
+                # Comparisons are False for NaNs, which also end up NaN here
+                if cxx[v] > 0.0 and cyy[v] > 0.0:
+                    r[v] = cxy[v] / np.sqrt(cxx[v] * cyy[v])
+                else:
+                    r[v] = np.nan
+        return r
+
+    @njit(error_model='numpy', cache=True)
+    def minmax_scale(a):
+        """
+        Rescale an array to the range [0, 1], finding the minimum and maximum
+        in one pass and writing the output in a second. Any NaN makes the
+        whole output NaN, as with np.min/np.max, and so does a constant array
+        (zero range).
+        """
+        flat = a.ravel()
+        mn = flat[0]
+        mx = flat[0]
+        for x in flat:
+            if np.isnan(x):
+                return np.full(a.shape, np.nan, dtype=a.dtype)
+            if x < mn:
+                mn = x
+            if x > mx:
+                mx = x
+        out = np.empty(flat.size, dtype=a.dtype)
+        for i in range(flat.size):
+            out[i] = (flat[i] - mn) / (mx - mn)
+        return out.reshape(a.shape)
+
+    @njit(cache=True)
+    def signed_mean(a, above_zero):
+        """
+        Mean of the positive (above_zero=True) or negative values of an array
+        without building a NaN-filled copy; NaN if there are none.
+        """
+        total = 0.0
+        count = 0
+        for x in a.ravel():
+            if (above_zero and x > 0.0) or (not above_zero and x < 0.0):
+                total += x
+                count += 1
+        if count == 0:
+            return np.nan
+        return total / count
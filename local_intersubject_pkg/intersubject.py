@@ -2,7 +2,7 @@
 # Purpose: Contains isc functions that expand on the designs in 
 # brainiak's isc module.
 
-from functools import partial
+from functools import partial, lru_cache
 from datetime import timedelta
 import logging
 
@@ -10,19 +10,76 @@ import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from nibabel import Nifti1Image
-from scipy.stats import pearsonr, spearmanr
+from scipy.stats import rankdata
 from scipy.ndimage import gaussian_filter, gaussian_filter1d
-from scipy.spatial.distance import squareform
+from scipy.spatial.distance import euclidean
 from .utils.bnk_funcs import (array_correlation, _check_timeseries_input,
                             _threshold_nans, compute_summary_statistic)
+from ._kernels import NUMBA_AVAILABLE
+if NUMBA_AVAILABLE:
+    from ._kernels import minmax_scale, signed_mean
 
 logger = logging.getLogger(__name__)
 
+# Approximate working set (bytes) of one voxel tile in pairwise ISC; sized to
+# stay resident in a typical per-core L2 cache
+PAIRWISE_TILE_BYTES = 2**20
+
 # ===================
 # Basic ISC functions
 # ===================
 
 
+def _correlate_timeseries(x, y):
+    """Pearson correlation along axis 0 (TRs) between two same-shaped arrays,
+    flattened to contiguous 2D arrays so array_correlation can use the
+    compiled kernel"""
+    n_TRs, out_shape = x.shape[0], x.shape[1:]
+    x = np.ascontiguousarray(x).reshape(n_TRs, -1)
+    y = np.ascontiguousarray(y, dtype=x.dtype).reshape(n_TRs, -1)
+    return array_correlation(x, y).reshape(out_shape)
+
+
+@lru_cache(maxsize=None)
+def _triu_indices(n):
+    """Cached upper-triangle indices (excluding the diagonal) of an n x n
+    matrix; the arrays are read-only since they are shared between calls"""
+    iu = np.triu_indices(n, k=1)
+    for idx in iu:
+        idx.flags.writeable = False
+    return iu
+
+
+def _pairwise_corr_tile(data, iu):
+    """Upper triangle of each voxel's subject-by-subject correlation matrix
+    for a (n_TRs, n_voxels, n_subjects) tile of voxels"""
+    # Center each subject's timeseries along the TR axis
+    centered = data - np.mean(data, axis=0, keepdims=True)
+
+    # Batched Gram matrix over voxels, shaped (n_voxels, n_subjects, n_subjects);
+    # its diagonal holds the sums of squares needed to normalize it
+    centered = np.ascontiguousarray(np.moveaxis(centered, 0, -1))
+    gram = np.matmul(centered, np.swapaxes(centered, 1, 2))
+    ss = np.sqrt(np.diagonal(gram, axis1=1, axis2=2))
+
+    # Normalize only the upper triangle that is kept
+    return (gram[:, iu[0], iu[1]] / (ss[:, iu[0]] * ss[:, iu[1]])).T
+
+
+def _loo_means(data, tolerate_nans):
+    """Leave-one-out group mean timeseries for every subject at once, derived
+    by subtracting each subject's timeseries from a single group sum"""
+    if tolerate_nans:
+        # Scan for NaNs once, then use plain sums on zero-filled data
+        valid = ~np.isnan(data)
+        data0 = np.where(valid, data, 0)
+        total = np.sum(data0, axis=2, keepdims=True)
+        counts = np.sum(valid, axis=2, keepdims=True, dtype=data.dtype)
+        return (total - data0) / (counts - valid)
+    total = np.sum(data, axis=2, keepdims=True)
+    return (total - data) / (data.shape[2] - 1)
+
+
 def isc(data, pairwise=False, 
         summary_statistic=None, 
         tolerate_nans=True, 
@@ -55,8 +112,8 @@ def isc(data, pairwise=False,
         voxel.
 
     n_jobs: int, default=None
-        Number of processers to devote to performing computation
-        in parallel. If None, then a normal for loop with be used;
+        Number of threads to devote to computing pairwise ISC voxel tiles
+        in parallel. If None or 1, then a normal for loop with be used;
         if -1, then all processors will be used to parallelize computation. 
 
         This function extends the Brainiak ISC implementation with 
@@ -78,62 +135,48 @@ def isc(data, pairwise=False,
         logger.info("Only two subjects! Simply computing Pearson correlation.")
         summary_statistic = None
 
-    # Check tolerate_nans input and use either mean/nanmean and exclude voxels
-    if tolerate_nans:
-        mean = np.nanmean
-    else:
-        mean = np.mean
+    # Exclude voxels based on tolerate_nans input
     data, mask = _threshold_nans(data, tolerate_nans)
 
     # Compute correlation for only two participants
     if n_subjects == 2:
 
         # Compute correlation for each corresponding voxel
-        iscs_stack = array_correlation(data[..., 0],
-                                       data[..., 1])[np.newaxis, :]
+        iscs_stack = _correlate_timeseries(data[..., 0],
+                                           data[..., 1])[np.newaxis, :]
 
-    # Compute pairwise ISCs using voxel loop and corrcoef for speed
+    # Compute pairwise ISCs with a batched matrix product over tiles of voxels
     elif pairwise:
-
-        # Swap axes for np.corrcoef
-        data = np.swapaxes(data, 2, 0)
-      
-        pairwise_corr = lambda x: squareform(np.corrcoef(x), checks=False)
-
-        # Loop through voxels
-        if n_jobs is not None:
-            with Parallel(n_jobs=n_jobs, **joblib_kwargs) as parallel:
-                voxel_iscs = parallel(delayed(pairwise_corr)(data[:,v,:])
-                                    for v in range(data.shape[1]))
+        iu = _triu_indices(n_subjects)
+        tile_size = max(1, PAIRWISE_TILE_BYTES // (n_TRs * n_subjects
+                                                   * data.itemsize))
+        tiles = [slice(v, v + tile_size)
+                 for v in range(0, data.shape[1], tile_size)]
+        iscs_stack = np.empty((len(iu[0]), data.shape[1]), dtype=data.dtype)
+
+        def fill_tile(tile):
+            iscs_stack[:, tile] = _pairwise_corr_tile(data[:, tile], iu)
+
+        # Tiles are independent and BLAS releases the GIL, so use threads
+        if n_jobs not in (None, 1):
+            with Parallel(n_jobs=n_jobs,
+                          **{'prefer': 'threads', **joblib_kwargs}) as parallel:
+                parallel(delayed(fill_tile)(tile) for tile in tiles)
         else:
-            voxel_iscs = []
-            for v in np.arange(data.shape[1]):
-                voxel_data = data[:, v, :]
-
-                # Correlation matrix for all pairs of subjects (triangle)
-                iscs = squareform(np.corrcoef(voxel_data), checks=False)
-                voxel_iscs.append(iscs)
-
-        iscs_stack = np.column_stack(voxel_iscs)
+            for tile in tiles:
+                fill_tile(tile)
 
     # Compute leave-one-out ISCs
     elif not pairwise:
-        loo_corr = lambda x, s: array_correlation(
-                                    x[...,s],
-                                    mean(np.delete(x, s, axis=2), axis=2))
-        if n_jobs is not None:
-            with Parallel(n_jobs=n_jobs, **joblib_kwargs) as parallel:
-                iscs_stack = parallel(delayed(loo_corr)(data, s)
-                                    for s in range(n_subjects))
-        else:
-            iscs_stack = [loo_corr(data, s) for s in range(n_subjects)]
-            
-        iscs_stack = np.array(iscs_stack)
-#         iscs_stack = np.array(loo_corr(data, tolerate_nans, n_jobs))
+
+        # Correlate every subject with their leave-one-out mean in one call
+        iscs_stack = _correlate_timeseries(data,
+                                           _loo_means(data, tolerate_nans)).T
 
     # Get ISCs back into correct shape after masking out NaNs
-    iscs = np.full((iscs_stack.shape[0], n_voxels), np.nan)
-    iscs[:, np.where(mask)[0]] = iscs_stack
+    iscs = np.full((iscs_stack.shape[0], n_voxels), np.nan,
+                   dtype=data.dtype)
+    iscs[:, mask] = iscs_stack
 
     # Summarize results (if requested)
     if summary_statistic:
@@ -178,12 +221,12 @@ def wmb_isc(d1, d2, subtract_wmb=False, summary_statistic=None,
         voxel.
 
     n_jobs: int, default=None
-        Number of processers to devote to performing computation
-        in parallel. If None, then a normal for loop with be used;
-        if -1, then all processors will be used to parallelize computation. 
+        Unused; within- and between-group ISCs are each computed in one
+        batched call per group. Kept for compatibility with callers that
+        pass it (eg., isc_by_segment).
 
-        This function extends the Brainiak ISC implementation with 
-        Joblib parallelisation.
+    joblib_kwargs: dict, default={}
+        Unused; see n_jobs.
         
     Returns
     -------
@@ -208,49 +251,37 @@ def wmb_isc(d1, d2, subtract_wmb=False, summary_statistic=None,
     elif summary_statistic=='median':
         summary_statistic = np.nanmedian
 
-    d1_and_d2 = np.append(d1, d2, axis=-1)
+    # Threshold both groups together in one preallocated buffer; d1 and d2
+    # are then views into it
+    d1_and_d2 = np.empty((d1_n_TRs, d1_n_voxels, d1_n_subs + d2_n_subs),
+                         dtype=np.result_type(d1, d2))
+    d1_and_d2[..., : d1_n_subs] = d1
+    d1_and_d2[..., d1_n_subs :] = d2
     d1_and_d2, mask = _threshold_nans(d1_and_d2, tolerate_nans)
     d1 = d1_and_d2[..., : d1_n_subs]
     d2 = d1_and_d2[..., d1_n_subs :]
-    del d1_and_d2
     # d2, d2_mask = _threshold_nans(d2, tolerate_nans)
     
     # Calculate within and between group isc for each group separately, then append
-    loo_corr = lambda x, s: array_correlation(
-                                x[...,s],
-                                mean(np.delete(x, s, axis=2), axis=2))
-    one2avg_corr = lambda x_i, y: array_correlation(
-                                    x_i, 
-                                    mean(y, axis=2), axis=2)
-    
-    w_iscs_stack = []
-    b_iscs_stack = []
     data_tup = (d1, d2)
-    if n_jobs is not None:
-        with Parallel(n_jobs=n_jobs, **joblib_kwargs) as parallel:
-            for idx, d in enumerate(data_tup):
-                n_subjects = data_tup[idx].shape[-1]
-                w_iscs_stack += parallel(delayed(loo_corr)(data_tup[idx], s)
-                                        for s in range(n_subjects))
-                b_iscs_stack += parallel(delayed(one2avg_corr)(data_tup[idx][...,s], data_tup[idx-1])
-                                        for s in range(n_subjects))
-                    
-    else:
-        for idx, d in enumerate(data_tup):
-            n_subjects = data_tup[idx].shape[-1]
-            for s in range(n_subjects):
-                w_iscs_stack.append(loo_corr(data_tup[idx], s))
-                
-                b_iscs_stack.append(one2avg_corr(data_tup[idx][...,s], 
-                                                data_tup[idx-1]))
+    w_iscs_stack = [_correlate_timeseries(d, _loo_means(d, tolerate_nans)).T
+                    for d in data_tup]
+    # Likewise, correlate every subject with the other group's mean in one
+    # call per group
+    group_means = [mean(d, axis=2) for d in data_tup]
+    b_iscs_stack = [_correlate_timeseries(
+                        d, np.broadcast_to(group_means[idx-1][..., None], d.shape)).T
+                    for idx, d in enumerate(data_tup)]
     
-    w_iscs_stack, b_iscs_stack = np.array(w_iscs_stack), np.array(b_iscs_stack)
+    w_iscs_stack, b_iscs_stack = np.vstack(w_iscs_stack), np.vstack(b_iscs_stack)
     
     # Get original data shape after masking out NaNs
-    within_isc = np.full((w_iscs_stack.shape[0], d1_n_voxels), np.nan)
-    between_isc = np.full((b_iscs_stack.shape[0], d1_n_voxels), np.nan)
-    within_isc[:, np.where(mask)[0]] = w_iscs_stack
-    between_isc[:, np.where(mask)[0]] = b_iscs_stack
+    within_isc = np.full((w_iscs_stack.shape[0], d1_n_voxels), np.nan,
+                         dtype=w_iscs_stack.dtype)
+    between_isc = np.full((b_iscs_stack.shape[0], d1_n_voxels), np.nan,
+                          dtype=b_iscs_stack.dtype)
+    within_isc[:, mask] = w_iscs_stack
+    between_isc[:, mask] = b_iscs_stack
 
     wmb_iscs = np.array([within_isc, between_isc])
     if subtract_wmb:
@@ -259,7 +290,9 @@ def wmb_isc(d1, d2, subtract_wmb=False, summary_statistic=None,
             # wmb_iscs = compute_summary_statistic(wmb_iscs,
             #                                 summary_statistic=summary_statistic,
             #                                 axis=0)[np.newaxis, :].squeeze(axis=0)
-            wmb_iscs = summary_statistic(wmb_iscs, axis=0)
+            # Sorting subjects first keeps the summary independent of group
+            # order, so wmb_isc(d1, d2) and wmb_isc(d2, d1) tie exactly
+            wmb_iscs = summary_statistic(np.sort(wmb_iscs, axis=0), axis=0)
             
         # return wmb_iscs
         return wmb_iscs.T
@@ -268,7 +301,7 @@ def wmb_isc(d1, d2, subtract_wmb=False, summary_statistic=None,
             # wmb_iscs = compute_summary_statistic(wmb_iscs,
             #                                 summary_statistic=summary_statistic,
             #                                 axis=1)[np.newaxis, :].squeeze(axis=0)
-            wmb_iscs = summary_statistic(wmb_iscs, axis=1)
+            wmb_iscs = summary_statistic(np.sort(wmb_iscs, axis=1), axis=1)
         return wmb_iscs.T
 
 # ===========================
@@ -356,8 +389,6 @@ def isc_by_segment(data, seg_trs, method='loo', summary_statistic=None, tolerate
     except:
         raise "data TR length be divisble by seg_trs with no remainder."
     n_segments = int(n_TRs / seg_trs)
-    seg_idx = n_segments
-    segment_isc = []
     
     if method == 'loo':
         isc_func = partial(isc, pairwise=False, 
@@ -372,15 +403,23 @@ def isc_by_segment(data, seg_trs, method='loo', summary_statistic=None, tolerate
         isc_func = partial(wmb_isc, subtract_wmb=subtract_wmb, tolerate_nans=tolerate_nans,
                           n_jobs=n_jobs)
 
-    while seg_idx > 0:
-        start = (n_segments - seg_idx) * seg_trs
-        end = ((n_segments - seg_idx) + 1) * seg_trs
-        if method == 'wmb':
-            segment_isc.append(isc_func(data[0][start:end], data[1][start:end]))
-        else:
-            segment_isc.append(isc_func(data[start : end]))
-        seg_idx -= 1
-    return np.array(segment_isc)
+    # Every segment's voxels are computed independently, so all segments
+    # can be run through a single ISC call as extra voxels
+    if method == 'wmb':
+        data = [_segments_as_voxels(d, seg_trs) for d in data]
+        segment_isc = isc_func(*data)
+    else:
+        segment_isc = isc_func(_segments_as_voxels(data, seg_trs))
+    return segment_isc.reshape(n_segments, -1, *segment_isc.shape[1:])
+
+
+def _segments_as_voxels(data, seg_trs):
+    """Reshape (n_TRs, n_voxels, n_subjects) data into (seg_trs,
+    n_segments * n_voxels, n_subjects), treating each segment's voxels as
+    separate voxels"""
+    data, n_TRs, n_voxels, n_subjects = _check_timeseries_input(data)
+    data = data.reshape(n_TRs // seg_trs, seg_trs, n_voxels, n_subjects)
+    return np.swapaxes(data, 0, 1).reshape(seg_trs, -1, n_subjects)
 
 
 def tr_mask_from_segments(n_trs, seg_mask):
@@ -389,11 +428,7 @@ def tr_mask_from_segments(n_trs, seg_mask):
     
     # infer how many TRs are represented by the seg_mask
     seg_size_trs = n_trs // len(seg_mask)
-    tr_mask = np.full(n_trs, False)
-    for i, seg in enumerate(seg_mask):
-        if seg == True:
-            tr_mask[seg_size_trs*i : seg_size_trs*(i+1)] = np.full(seg_size_trs, True)
-    return tr_mask
+    return np.repeat(np.asarray(seg_mask, dtype=bool), seg_size_trs)
 
 
 def filter_segment_trs(data, seg_mask, axis=0):
@@ -445,6 +480,13 @@ def timestamps_from_segments(n_segs, n_trs, TR, return_as="h:m:s"):
 # =======================
 
 
+def _corr_rows_with_vector(rows, vec):
+    """Pearson correlation between each row of a 2d array and a vector"""
+    rows = rows - np.mean(rows, axis=1, keepdims=True)
+    vec = vec - np.mean(vec)
+    return (rows @ vec) / (np.linalg.norm(rows, axis=1) * np.linalg.norm(vec))
+
+
 def finn_isrsa(pwise_isc=None, pwise_behav=None, 
                neural_data=None, behav_data=None,
                pwise_func=None, tri_func=None, 
@@ -473,18 +515,22 @@ def finn_isrsa(pwise_isc=None, pwise_behav=None,
 
     logger.debug(f"Running finn_isrsa()")
 
-    if tri_func in ['spearman', None]:
-        tri_func = lambda x1, x2: spearmanr(x1, x2)[0]
-    elif tri_func == 'pearson':
-        tri_func = lambda x1, x2: pearsonr(x1, x2)[0]
-    
-    
     if pwise_isc is None:
         pwise_isc = isc(neural_data, pairwise=True, n_jobs=n_jobs)
     if pwise_behav is None:
         pwise_behav = pwise_func(behav_data)
+
+    # Correlate every node at once; Spearman is computed as Pearson
+    # correlation on ranks, with the behavioral ranks computed only once
+    if tri_func in ['spearman', 'pearson', None]:
+        pwise_isc = np.asarray(pwise_isc, dtype=float)
+        pwise_behav = np.asarray(pwise_behav, dtype=float)
+        if tri_func != 'pearson':
+            pwise_isc = rankdata(pwise_isc, axis=1)
+            pwise_behav = rankdata(pwise_behav)
+        return _corr_rows_with_vector(pwise_isc, pwise_behav)
     
-    if n_jobs is not None:
+    if n_jobs not in (None, 1):
         # pwise_behav = tri2vect(pwise_behav)
         with Parallel(n_jobs, **joblib_kwargs) as parallel:
             isrsa_by_node = parallel(delayed(tri_func)(pwise_isc[i], pwise_behav)
@@ -512,6 +558,10 @@ def reorder_square_mtx(mtx, sort_idx, sort=True):
     return mtx_sorted
     
 def scale_mtx(mtx):
+    """Rescale a matrix's values to the range [0, 1]"""
+    if (NUMBA_AVAILABLE and isinstance(mtx, np.ndarray) and mtx.size
+            and mtx.dtype.kind == 'f'):
+        return minmax_scale(mtx)
     return (mtx-np.min(mtx)) / (np.max(mtx) - np.min(mtx))
 
 def tri2vect(mtx, upper=True, sort_idx=None, k=None):
@@ -532,11 +582,35 @@ def tri2vect(mtx, upper=True, sort_idx=None, k=None):
         trifunc = partial(np.tril_indices, k=k)
     return mtx[trifunc(mtx.shape[0])]
 
-def pair_scalar(fn, x):
+def pair_scalar(fn, x, symmetric=False):
+    """
+    Compute fn(x[i], x[j]) for every pair of rows in x, returning an
+    (n_rows, n_rows) matrix (eg., a subject-by-subject behavioral similarity
+    matrix for IS-RSA).
+
+    fn can also be 'euclidean' (scipy.spatial.distance.euclidean is treated
+    the same) or 'mean' (the "Anna Karenina" model from Finn et al. (2020),
+    averaging each pair's scores), which are computed with broadcasting
+    instead of calling a function for every pair.
+
+    If symmetric=True, fn is assumed to give fn(a, b) == fn(b, a), so only
+    the upper triangle (and diagonal) is computed and then mirrored.
+    """
+    x = np.asarray(x)
+    if fn == 'euclidean' or fn is euclidean:
+        rows = x.reshape(x.shape[0], -1)
+        return np.linalg.norm(rows[:, None] - rows[None, :], axis=-1)
+    elif fn == 'mean':
+        row_means = x.reshape(x.shape[0], -1).mean(axis=1)
+        return (row_means[:, None] + row_means[None, :]) / 2
+
     out = np.full((x.shape[0], x.shape[0]), np.nan)
     for i in range(x.shape[0]):
-        for j in range(x.shape[0]):
+        for j in range(i if symmetric else 0, x.shape[0]):
             out[i, j] = fn(x[i], x[j])
+    if symmetric:
+        il = np.tril_indices(x.shape[0], k=-1)
+        out[il] = out.T[il]
     return out
 
 def avg_corr(avg_fn, data, above_zero=True):
@@ -544,6 +618,12 @@ def avg_corr(avg_fn, data, above_zero=True):
     Return the average positive (or negative) correlation in an array
     of correlation values range from -1 to 1. 
     """
+    # The mean can be taken in one pass without a NaN-filled copy
+    if (NUMBA_AVAILABLE and avg_fn is np.nanmean
+            and isinstance(data, np.ndarray) and data.dtype.kind == 'f'):
+        # Cast back so the result's dtype matches np.nanmean's
+        return data.dtype.type(signed_mean(data, above_zero))
+
     if above_zero:
         data = np.where(data > 0.0, data, np.nan)
     else: 
@@ -3,6 +3,9 @@
 # limitations.
 import logging
 import numpy as np
+from .._kernels import NUMBA_AVAILABLE
+if NUMBA_AVAILABLE:
+    from .._kernels import pearson_batched
 
 logger = logging.getLogger(__name__)
 
@@ -122,7 +125,8 @@ def _check_timeseries_input(data):
     Returns
     -------
     data : ndarray
-        Input time series data with standardized structure
+        Input time series data with standardized structure (C-contiguous,
+        at least float32)
     n_TRs : int
         Number of time points (TRs)
     n_voxels : int
@@ -152,6 +156,10 @@ def _check_timeseries_input(data):
             raise ValueError("Input ndarray should have 2 "
                              "or 3 dimensions (got {0})!".format(data.ndim))
 
+    # Use a contiguous floating point array, keeping the caller's precision
+    # (float32 input stays float32 so downstream BLAS runs in single precision)
+    data = np.ascontiguousarray(data, dtype=np.result_type(data, np.float32))
+
     # Infer subjects, TRs, voxels and log for user to check
     n_TRs, n_voxels, n_subjects = data.shape
     logger.info("Assuming {0} subjects with {1} time points "
@@ -203,6 +211,12 @@ def array_correlation(x, y, axis=0):
     if axis == 1:
         x, y = x.T, y.T
 
+    # Use the compiled single-pass kernel for contiguous 2D float arrays
+    if (NUMBA_AVAILABLE and x.ndim == 2 and x.dtype == y.dtype
+            and x.dtype in (np.float32, np.float64)
+            and x.flags.c_contiguous and y.flags.c_contiguous):
+        return pearson_batched(x, y)
+
     # Center (de-mean) input variables
     x_demean = x - np.mean(x, axis=0)
     y_demean = y - np.mean(y, axis=0)
@@ -256,18 +256,22 @@ def prep_data(files_dict=None, nifti_func=None, output_path=None,
         # Check for numpy.npy or NIfTI file
         try:
             if id_path.endswith(".npy"):
-                data = np.load(id_path) # .npy files are assumed to have same dimensions
+                data = np.asarray(np.load(id_path), dtype=np.float32) # .npy files are assumed to have same dimensions
             elif id_path.endswith(".nii.gz"):
-                data = nib.load(id_path).get_fdata()[:,:,:, 0: cutoff_column]
+                # Slice the image's array proxy so only the kept TRs are read
+                img = nib.load(id_path)
+                data = np.asarray(img.dataobj[..., : cutoff_column],
+                                  dtype=np.float32)
         except:
             print("Unrecognized file type.")
             break
 
         # reshape 4d array to matrix
-        # Note: rows=voxels, columns=TRs
+        # Note: rows=voxels, columns=TRs; data was loaded as float32, so
+        # this is a view rather than another copy
         datasize = data.shape # NOTE: this is the second datasize retrieval and could cause intended errors 
         data = data.reshape((datasize[0] * datasize[1] * datasize[2]),
-                            datasize[3]).astype(np.float32)
+                            datasize[3])
         
         # create boolean mask based on each voxel's mean (optional)
         if cutoff_mean:
@@ -277,7 +281,8 @@ def prep_data(files_dict=None, nifti_func=None, output_path=None,
 
         # Save prepped data
         out_file = os.path.join(output_path, out_file.format(id_))
-        restored_data = np.full((datasize[0]*datasize[1]*datasize[2], datasize[3]), np.nan)
+        restored_data = np.full((datasize[0]*datasize[1]*datasize[2], datasize[3]), np.nan,
+                                dtype=np.float32)
         restored_data[mask, :] = data
         if out_file.endswith(".nii.gz"):
             save_data(out_file, data=restored_data,
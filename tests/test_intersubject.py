@@ -1,14 +1,22 @@
 # test_intersubject.py
 
 from functools import partial
+import os
+import subprocess
+import sys
 import numpy as np
 import numpy.testing as np_test
 from scipy.ndimage import gaussian_filter1d
 import logging
 import pytest
 from local_intersubject_pkg.intersubject import (isc, wmb_isc, finn_isrsa,
-                                                dynamic_func, window_generator)
+                                                dynamic_func, window_generator,
+                                                tr_mask_from_segments,
+                                                isc_by_segment, pair_scalar,
+                                                avg_corr)
+from local_intersubject_pkg import intersubject
 from scipy.spatial.distance import squareform
+from scipy.stats import pearsonr, spearmanr
 
 logger = logging.getLogger(__name__)
 
@@ -127,6 +135,64 @@ class TestIsc:
         logger.info("Finished testing ISC outputs")
 
 
+    # Check vectorized pairwise ISC against per-voxel np.corrcoef
+    def test_isc_pairwise_matches_corrcoef(self, fxt_simulated_timeseries):
+
+        data = fxt_simulated_timeseries(self.n_subjects, self.n_TRs,
+                                    n_voxels=self.n_voxels, data_type='array',
+                                    random_state=self.random_state)
+
+        ref_iscs = np.array([squareform(np.corrcoef(data[:, v, :].T),
+                                        checks=False)
+                             for v in range(self.n_voxels)])
+        obs_iscs = isc(data, pairwise=True)
+        np_test.assert_allclose(obs_iscs, ref_iscs, rtol=1e-5, atol=1e-6)
+
+
+    # Check ISCs keep the input's floating point precision
+    @pytest.mark.parametrize('dtype', [np.float32, np.float64])
+    @pytest.mark.parametrize('pairwise', [False, True])
+    def test_isc_dtype(self, dtype, pairwise, fxt_simulated_timeseries):
+
+        data = fxt_simulated_timeseries(self.n_subjects, self.n_TRs,
+                                    n_voxels=self.n_voxels, data_type='array',
+                                    random_state=self.random_state)
+        assert isc(data.astype(dtype), pairwise=pairwise).dtype == dtype
+
+
+    # Check threaded pairwise ISC tiles match the serial loop
+    def test_isc_parallel_equality(self, fxt_simulated_timeseries,
+                                   monkeypatch):
+
+        # Shrink tiles so the voxels are split across several threads
+        monkeypatch.setattr(intersubject, 'PAIRWISE_TILE_BYTES',
+                            self.n_TRs * self.n_subjects * 8 * 4)
+        data = fxt_simulated_timeseries(self.n_subjects, self.n_TRs,
+                                    n_voxels=self.n_voxels, data_type='array',
+                                    random_state=self.random_state)
+        np_test.assert_array_equal(isc(data, pairwise=True, n_jobs=2),
+                                   isc(data, pairwise=True))
+
+
+    # Check leave-one-out ISC against explicitly excluding each subject
+    def test_isc_loo_matches_reference(self, fxt_simulated_timeseries):
+
+        data = fxt_simulated_timeseries(self.n_subjects, self.n_TRs,
+                                    n_voxels=self.n_voxels, data_type='array',
+                                    random_state=self.random_state)
+        data[0, 0, 0] = np.nan
+        data[:, 1, 1] = np.nan
+
+        ref_iscs = np.array([
+            [np.corrcoef(data[:, v, s],
+                         np.nanmean(np.delete(data[:, v, :], s, axis=1),
+                                    axis=1))[0, 1]
+             for s in range(self.n_subjects)]
+            for v in range(self.n_voxels)])
+        obs_iscs = isc(data, pairwise=False, tolerate_nans=True)
+        np_test.assert_allclose(obs_iscs, ref_iscs, rtol=1e-5, atol=1e-6)
+
+
     # Check for proper handling of NaNs in ISC
     def test_isc_nans(self, fxt_simulated_timeseries):
 
@@ -316,6 +382,59 @@ class TestWmbIsc:
         np_test.assert_array_equal(obs_b_halfA, obs_b_halfB)
 
 
+    def test_between_matches_reference(self):
+        """
+        Check that the batched between-group ISCs match correlating each
+        subject with the other group's mean one at a time
+        """
+        rng = np.random.default_rng(0)
+        d1 = rng.normal(size=(100, 30, 5))
+        d2 = rng.normal(size=(100, 30, 4))
+
+        obs_between = wmb_isc(d1, d2)[..., 1]
+        for s, (d, other) in enumerate([(d1[..., s], d2) for s in range(5)]
+                                       + [(d2[..., s], d1) for s in range(4)]):
+            other_mean = other.mean(axis=2)
+            expected = [pearsonr(d[:, v], other_mean[:, v])[0]
+                        for v in range(d.shape[1])]
+            np_test.assert_allclose(obs_between[:, s], expected, atol=1e-10)
+
+    def test_n_jobs_workqueue(self):
+        """
+        Check that n_jobs>1 doesn't call the parallel Numba kernel from
+        several threads at once, which aborts the process under Numba's
+        workqueue threading layer
+        """
+        pytest.importorskip("numba")
+        code = ("import numpy as np\n"
+                "from local_intersubject_pkg.intersubject import wmb_isc, isc\n"
+                "rng = np.random.default_rng(0)\n"
+                "d1 = rng.normal(size=(100, 3000, 6))\n"
+                "d2 = rng.normal(size=(100, 3000, 6))\n"
+                "wmb_isc(d1, d2, n_jobs=4)\n"
+                "isc(d1, n_jobs=4)\n"
+                "isc(d1, pairwise=True, n_jobs=4)\n")
+        env = {**os.environ, 'NUMBA_THREADING_LAYER': 'workqueue'}
+        result = subprocess.run([sys.executable, '-c', code], env=env,
+                                capture_output=True, text=True)
+
+        assert result.returncode == 0, result.stderr
+
+    @pytest.mark.parametrize('subtract_wmb', [True, False])
+    def test_group_order_invariance(self, subtract_wmb):
+        """
+        Check that swapping the groups gives bit-identical summaries, so a
+        group-label permutation that swaps them ties the observed value
+        """
+        rng = np.random.default_rng(0)
+        d1 = rng.normal(size=(100, 30, 5))
+        d2 = rng.normal(size=(100, 30, 5)) * -5
+
+        obs = wmb_isc(d1, d2, subtract_wmb=subtract_wmb, summary_statistic='mean')
+        swapped = wmb_isc(d2, d1, subtract_wmb=subtract_wmb, summary_statistic='mean')
+        np_test.assert_array_equal(obs, swapped)
+
+
 class TestFinnIsrsa:
     def test_basic(self, fxt_ref_high_pos_neg_corr):
         rng = np.random.default_rng(0)
@@ -351,6 +470,27 @@ class TestFinnIsrsa:
         """)
         assert neg_isrsa[0] < -0.8 and neg_isrsa[2] > -0.8
 
+    @pytest.mark.parametrize('tri_func, ref_func', [
+        ('spearman', spearmanr), ('pearson', pearsonr)])
+    def test_matches_scipy(self, tri_func, ref_func):
+        rng = np.random.default_rng(0)
+        pwise_isc = rng.normal(size=(10, 45))
+        pwise_behav = rng.normal(size=45) + pwise_isc[0]
+
+        ref_isrsa = [ref_func(node, pwise_behav)[0] for node in pwise_isc]
+        obs_isrsa = finn_isrsa(pwise_isc, pwise_behav, tri_func=tri_func)
+        np_test.assert_allclose(obs_isrsa, ref_isrsa)
+
+    def test_callable_parallel_equality(self):
+        rng = np.random.default_rng(0)
+        pwise_isc = rng.normal(size=(10, 45))
+        pwise_behav = rng.normal(size=45)
+        tri_func = lambda x1, x2: spearmanr(x1, x2)[0]
+
+        np_test.assert_allclose(
+            finn_isrsa(pwise_isc, pwise_behav, tri_func=tri_func, n_jobs=2),
+            finn_isrsa(pwise_isc, pwise_behav, tri_func=tri_func))
+
 
 @pytest.fixture
 def ref_res1():
@@ -568,6 +708,93 @@ class TestWindowGenerator:
             assert r2 == o2
             logger.debug(f"r2 and o2 were equivlent!")
 
+
+class TestIscBySegment:
+    @pytest.mark.parametrize('method', ['loo', 'pairwise'])
+    @pytest.mark.parametrize('summary_statistic', [None, 'mean', 'median'])
+    @pytest.mark.parametrize('tolerate_nans', [True, False, .8])
+    def test_matches_isc_per_segment(self, method, summary_statistic,
+                                     tolerate_nans, fxt_simulated_timeseries):
+        seg_trs = 20
+        data = fxt_simulated_timeseries(10, 60, n_voxels=30,
+                                        data_type='array', random_state=42)
+
+        # NaNs confined to single segments should only affect those segments
+        data[0, 0, :] = np.nan
+        data[25, 1, :3] = np.nan
+        data[45, 2, 0] = np.nan
+
+        ref_iscs = np.array([isc(data[start : start+seg_trs],
+                                 pairwise=(method == 'pairwise'),
+                                 summary_statistic=summary_statistic,
+                                 tolerate_nans=tolerate_nans)
+                             for start in range(0, 60, seg_trs)])
+        obs_iscs = isc_by_segment(data, seg_trs, method=method,
+                                  summary_statistic=summary_statistic,
+                                  tolerate_nans=tolerate_nans)
+        assert obs_iscs.shape == ref_iscs.shape
+        np_test.assert_allclose(obs_iscs, ref_iscs, rtol=1e-5)
+
+    @pytest.mark.parametrize('subtract_wmb', [False, True])
+    def test_wmb_matches_wmb_isc_per_segment(self, subtract_wmb):
+        seg_trs = 20
+        rng = np.random.default_rng(0)
+        d1 = rng.normal(size=(60, 30, 5))
+        d2 = rng.normal(size=(60, 30, 4))
+
+        ref_iscs = np.array([wmb_isc(d1[start : start+seg_trs],
+                                     d2[start : start+seg_trs],
+                                     subtract_wmb=subtract_wmb)
+                             for start in range(0, 60, seg_trs)])
+        obs_iscs = isc_by_segment([d1, d2], seg_trs, method='wmb',
+                                  subtract_wmb=subtract_wmb)
+        assert obs_iscs.shape == ref_iscs.shape
+        np_test.assert_allclose(obs_iscs, ref_iscs, rtol=1e-5)
+
+
+class TestPairScalar:
+    @pytest.mark.parametrize('shape', [(8,), (8, 3)])
+    @pytest.mark.parametrize('fn, ref_fn', [
+        ('euclidean', lambda a, b: np.linalg.norm(np.atleast_1d(a - b))),
+        ('mean', lambda a, b: (np.mean(a) + np.mean(b)) / 2)])
+    def test_fast_paths(self, shape, fn, ref_fn):
+        x = np.random.default_rng(0).normal(size=shape)
+        ref = pair_scalar(ref_fn, x)
+        np_test.assert_allclose(pair_scalar(fn, x), ref)
+        np_test.assert_allclose(pair_scalar(ref_fn, x, symmetric=True), ref)
+
+    def test_asymmetric_fn(self):
+        x = np.arange(4.)
+        obs = pair_scalar(lambda a, b: a - b, x)
+        np_test.assert_array_equal(obs, x[:, None] - x[None, :])
+
+
+class TestTrMaskFromSegments:
+    def test_basic(self):
+        seg_mask = [True, False, False, True]
+        ref_mask = [True]*3 + [False]*6 + [True]*3
+
+        obs_mask = tr_mask_from_segments(12, seg_mask)
+        assert obs_mask.dtype == bool
+        np_test.assert_array_equal(ref_mask, obs_mask)
+
+    def test_indivisible_trs(self):
+        with pytest.raises(AssertionError):
+            tr_mask_from_segments(10, [True, False, True])
+
+class TestAvgCorr:
+    @pytest.mark.parametrize('dtype', [np.float32, np.float64])
+    @pytest.mark.parametrize('above_zero', [True, False])
+    def test_matches_nanmean(self, dtype, above_zero):
+        data = np.random.default_rng(0).uniform(-1, 1, size=(6, 6)).astype(dtype)
+        data[0, 0] = np.nan
+        keep = data > 0 if above_zero else data < 0
+        ref = np.nanmean(np.where(keep, data, np.nan))
+
+        obs = avg_corr(np.nanmean, data, above_zero=above_zero)
+        assert type(obs) is type(ref)
+        np_test.assert_allclose(obs, ref, rtol=1e-6)
+
 if __name__ == '__main__':
     TestIsc()
     logger.info("Finished all ISC tests")
\ No newline at end of file
@@ -0,0 +1,75 @@
+# test_kernels.py
+
+import numpy as np
+import numpy.testing as np_test
+import pytest
+from local_intersubject_pkg.utils.bnk_funcs import array_correlation
+
+pytest.importorskip("numba")
+from local_intersubject_pkg._kernels import (pearson_batched, minmax_scale,
+                                             signed_mean)
+
+
+class TestPearsonBatched:
+
+    @pytest.mark.parametrize('dtype', [np.float32, np.float64])
+    def test_matches_array_correlation(self, dtype):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(100, 40)).astype(dtype)
+        y = (x + rng.normal(size=x.shape)).astype(dtype)
+
+        np_test.assert_allclose(pearson_batched(x, y),
+                                array_correlation(x, y), rtol=1e-5)
+
+    def test_nan_and_constant_voxels(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(100, 3))
+        y = rng.normal(size=(100, 3))
+        x[0, 0] = np.nan
+        x[:, 1] = 1.
+
+        r = pearson_batched(x, y)
+        assert np.isnan(r[0]) and np.isnan(r[1]) and not np.isnan(r[2])
+
+    def test_large_offset(self):
+        rng = np.random.default_rng(0)
+        x = rng.normal(size=(300, 50)) + 1e4
+        y = x + rng.normal(size=x.shape)
+
+        np_test.assert_allclose(pearson_batched(x, y),
+                                array_correlation(x.T, y.T, axis=1),
+                                rtol=1e-10)
+
+
+class TestMinmaxScale:
+
+    @pytest.mark.parametrize('dtype', [np.float32, np.float64])
+    def test_matches_numpy(self, dtype):
+        a = np.random.default_rng(0).uniform(-1, 1, size=(6, 6)).astype(dtype)
+
+        obs = minmax_scale(a.T)
+        assert obs.dtype == dtype
+        np_test.assert_allclose(obs, (a.T - a.min()) / (a.max() - a.min()),
+                                rtol=1e-6)
+
+    def test_nan(self):
+        a = np.eye(3)
+        a[0, 1] = np.nan
+        assert np.all(np.isnan(minmax_scale(a)))
+
+    def test_constant(self):
+        assert np.all(np.isnan(minmax_scale(np.ones((3, 3)))))
+
+
+class TestSignedMean:
+
+    @pytest.mark.parametrize('above_zero', [True, False])
+    def test_matches_nanmean(self, above_zero):
+        a = np.random.default_rng(0).uniform(-1, 1, size=(6, 6))
+        a[0, 0] = np.nan
+        keep = a > 0 if above_zero else a < 0
+
+        np_test.assert_allclose(signed_mean(a, above_zero), np.mean(a[keep]))
+
+    def test_no_values(self):
+        assert np.isnan(signed_mean(np.zeros(3), True))